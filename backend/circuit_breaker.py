@@ -0,0 +1,94 @@
+"""
+Circuit Breaker for Payment Gateway
+Fails fast while a downstream dependency is degraded instead of piling on retries
+"""
+import threading
+import time
+
+# Circuit states
+CLOSED = "closed"  # Calls flow normally
+OPEN = "open"  # Calls are rejected until the sleep window passes
+HALF_OPEN = "half_open"  # A few trial calls decide whether to close again
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    - CLOSED: trips to OPEN after `failure_threshold` consecutive failures
+    - OPEN: rejects every call for `sleep_window_ms`, then goes HALF_OPEN
+    - HALF_OPEN: lets up to `half_open_max` trial calls through; a success
+      closes the circuit, a failure opens it again
+
+    State reads on the hot path are lock-free; the lock is only taken
+    for state transitions and failure bookkeeping.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        sleep_window_ms: int = 10000,
+        half_open_max: int = 3
+    ):
+        self.failure_threshold = failure_threshold
+        self.sleep_window_ms = sleep_window_ms
+        self.half_open_max = half_open_max
+
+        self.state = CLOSED
+        self._failures = 0
+        self._last_open_ts = 0.0
+        self._half_open_calls = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Check whether a call may proceed.
+
+        Raises CircuitOpenError if the circuit is open (or the half-open
+        trial budget is used up).
+        """
+        if self.state == CLOSED:
+            return
+
+        with self._lock:
+            if self.state == OPEN:
+                elapsed_ms = (time.monotonic() - self._last_open_ts) * 1000
+                if elapsed_ms < self.sleep_window_ms:
+                    raise CircuitOpenError("Circuit is open")
+                self.state = HALF_OPEN
+                self._half_open_calls = 0
+
+            if self.state == HALF_OPEN:
+                if self._half_open_calls >= self.half_open_max:
+                    raise CircuitOpenError("Circuit is half-open, trial calls in flight")
+                self._half_open_calls += 1
+
+    def record_success(self):
+        """Record a successful call"""
+        if self.state == CLOSED and self._failures == 0:
+            return
+
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        """Record a failed call, opening the circuit if needed"""
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = OPEN
+                self._last_open_ts = time.monotonic()
+
+    def release_call(self):
+        """
+        Give back a half-open trial slot for a call that ended without an
+        outcome (e.g. it was cancelled), so it doesn't hold the slot forever.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
@@ -7,14 +7,57 @@ import os
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongodb:27017")
 DATABASE_NAME = "payment_db"
 
+# MongoDB Connection Pool (sized for the load generator's concurrent bursts)
+MONGO_MAX_POOL_SIZE = 200
+MONGO_MIN_POOL_SIZE = 20
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 200
+MONGO_SOCKET_TIMEOUT_MS = 500
+MONGO_CONNECT_TIMEOUT_MS = 500
+MONGO_POOL_SHARDS = int(os.getenv("MONGO_POOL_SHARDS", "4"))  # Pools for payment-intent writes, keyed by merchant
+if MONGO_POOL_SHARDS < 1:
+    raise ValueError(f"MONGO_POOL_SHARDS must be at least 1, got {MONGO_POOL_SHARDS}")
+
 # OTP Configuration
 OTP_EXPIRY_MINUTES = 2
 OTP_TIMEOUT_MS = 400  # OTP service timeout in milliseconds
 
 # Payment Configuration  
 PAYMENT_RETRY_COUNT = 3
-PAYMENT_RETRY_DELAY_MS = 100
+PAYMENT_RETRY_DELAY_MS = 100  # Base delay, doubled on each retry (with jitter)
+PAYMENT_MAX_BACKOFF_MS = 1000  # Cap on the backoff delay
+
+# Bulkhead: max OTP generations in flight at once (excess requests queue)
+OTP_MAX_INFLIGHT = int(os.getenv("OTP_MAX_INFLIGHT", "20"))
+
+# OTP micro-batching: concurrent OTP creations share one database write
+OTP_BATCH_MAX_SIZE = 64  # Max payments per batch
+OTP_BATCH_WINDOW_MS = 5  # How long a batch waits for more payments
+
+# Async OTP queue (POST /payment/initiate-async)
+OTP_QUEUE_MAXSIZE = 1000  # Payments waiting for an OTP worker; beyond this -> 503
+OTP_WORKERS = int(os.getenv("OTP_WORKERS", "8"))  # OTP worker tasks started at boot
+OTP_RESULTS_MAX = 10000  # Generated OTPs held for polling before the oldest are dropped
+
+# Load shedding: reject new payments up front once the system is saturated
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "200"))  # Concurrent initiate_payment calls
+SHED_LATENCY_MS = 350  # Shed while recent OTP p99 is above this (just under OTP_TIMEOUT_MS)
+SHED_WINDOW_MS = 2000  # Only OTP samples this recent count towards the p99
+SHED_MIN_SAMPLES = 20  # Don't judge the p99 on fewer samples than this
+SHED_REFRESH_MS = 100  # How often the cached p99 is recomputed
+
+# Circuit Breaker around OTP generation
+OTP_BREAKER_FAILURE_THRESHOLD = 5  # Consecutive failures before the circuit opens
+OTP_BREAKER_SLEEP_WINDOW_MS = 10000  # How long the circuit stays open
+OTP_BREAKER_HALF_OPEN_MAX = 3  # Trial calls allowed while half-open
+
+# Audit Log Configuration (background writer)
+AUDIT_FLUSH_SIZE = 100  # Flush once this many entries are queued...
+AUDIT_FLUSH_INTERVAL_MS = 50  # ...or once the oldest has waited this long
+MAX_DB_BATCH_SIZE = int(os.getenv("MAX_DB_BATCH_SIZE", "1000"))  # Per insert_many; 0 disables batching
 
 # Simulated latencies (for realistic behavior)
 BASE_WRITE_LATENCY_MS = 15  # Base DB write latency
 CONTENTION_FACTOR = 1.5  # How much contention increases latency per concurrent txn
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # payment_service emits one timing event per phase at INFO
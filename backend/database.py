@@ -3,42 +3,102 @@ Database Layer for Payment Gateway
 Handles MongoDB operations for payment intents and OTP sessions
 """
 import time
-import uuid
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, Dict, Any
-from pymongo import MongoClient
+from typing import Optional, Dict, Any, List, Tuple
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument
 from pymongo.errors import PyMongoError
 
 from config import (
     MONGO_URI, 
     DATABASE_NAME,
     BASE_WRITE_LATENCY_MS,
-    CONTENTION_FACTOR
+    CONTENTION_FACTOR,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_POOL_SHARDS
 )
 
-# Thread-safe counter for active transactions
-_active_transactions = 0
-_transaction_lock = threading.Lock()
+# Per-thread counters for active transactions: each thread only writes its
+# own slot and readers sum the slots, so the write path takes no lock at all
+_counter_slots = []
+_slot_local = threading.local()
+_slot_register_lock = threading.Lock()
+
+# Per-payment readiness events, so OTP lookups wait instead of polling
+_ready_events: Dict[str, threading.Event] = {}
+_ready_lock = threading.Lock()
+_EPOCH = datetime(1970, 1, 1)
+
+# The main pool and the payment-intent shard pools split one connection
+# budget evenly, so sharding doesn't multiply the per-process connections
+_POOL_SLICES = MONGO_POOL_SHARDS + 1
+_SLICE_MAX_POOL_SIZE = max(1, MONGO_MAX_POOL_SIZE // _POOL_SLICES)
+_SLICE_MIN_POOL_SIZE = MONGO_MIN_POOL_SIZE // _POOL_SLICES
+
+# Collection handles, bound by DatabaseConnection when it first connects rather
+# than at import, so importing this module never touches the network
+_connect_lock = threading.Lock()
+_payment_intents = None
+_otp_sessions = None
+
+
+def _new_client(max_pool_size: int, min_pool_size: int) -> MongoClient:
+    """Create a MongoClient (and so a connection pool) with the gateway's settings"""
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        retryWrites=True
+    )
 
 
 class DatabaseConnection:
     """Singleton database connection manager"""
     _instance = None
     _client = None
+    _shard_clients = []
     _db = None
     
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._client = MongoClient(MONGO_URI)
-            cls._db = cls._client[DATABASE_NAME]
+            with _connect_lock:
+                if cls._instance is None:
+                    cls._connect()
         return cls._instance
     
+    @classmethod
+    def _connect(cls):
+        """Build the clients and bind the module's collection handles (warmup() opens the sockets)"""
+        global _payment_intents, _otp_sessions
+        cls._client = _new_client(_SLICE_MAX_POOL_SIZE, _SLICE_MIN_POOL_SIZE)
+        # Independent pools for payment-intent writes, so merchants spread
+        # over several pool mutexes instead of all queueing on one
+        cls._shard_clients = [
+            _new_client(_SLICE_MAX_POOL_SIZE, _SLICE_MIN_POOL_SIZE)
+            for _ in range(MONGO_POOL_SHARDS)
+        ]
+        cls._db = cls._client[DATABASE_NAME]
+        _payment_intents = cls._db.payment_intents
+        _otp_sessions = cls._db.otp_sessions
+        cls._instance = super().__new__(cls)
+    
     @property
     def db(self):
         return self._db
     
+    @property
+    def shard_clients(self):
+        return self._shard_clients
+    
     @property
     def client(self):
         return self._client
@@ -54,15 +114,56 @@ def get_client():
     return DatabaseConnection().client
 
 
+def get_pool(key: str) -> MongoClient:
+    """Get the payment-intent connection pool that serves this key (e.g. a merchant_id)"""
+    return DatabaseConnection().shard_clients[hash(key) % MONGO_POOL_SHARDS]
+
+
+def warmup(connections: int = MONGO_MIN_POOL_SIZE):
+    """
+    Open `connections` pooled sockets before traffic arrives, split evenly
+    across the main pool and the payment-intent shard pools.
+    
+    The pings run concurrently so each checks out its own connection,
+    growing the pool instead of reusing one socket over and over.
+    """
+    per_client = max(1, connections // _POOL_SLICES)
+    with ThreadPoolExecutor(max_workers=per_client) as pool:
+        for client in [get_client()] + DatabaseConnection().shard_clients:
+            list(pool.map(client.admin.command, ["ping"] * per_client))
+
+
+def _ensure_connected():
+    """Connect on first use; afterwards just a global check on the hot path"""
+    if _otp_sessions is None:
+        DatabaseConnection()
+
+
+def _as_object_id(value: Any) -> Optional[ObjectId]:
+    """Coerce an id that crossed the API boundary as a string back to an ObjectId"""
+    if isinstance(value, ObjectId):
+        return value
+    return ObjectId(value) if ObjectId.is_valid(value) else None
+
+
+def _slot_index() -> int:
+    """Get this thread's private counter slot, registering it on first use"""
+    try:
+        return _slot_local.index
+    except AttributeError:
+        with _slot_register_lock:
+            _counter_slots.append(0)
+            _slot_local.index = len(_counter_slots) - 1
+        return _slot_local.index
+
+
 def _simulate_write_latency():
     """
     Simulate realistic write latency that increases with contention.
     This models real-world behavior where concurrent writes slow each other.
     """
-    global _active_transactions
-    
-    with _transaction_lock:
-        concurrent = _active_transactions
+    # Advisory lock-free sum - may be slightly stale, fine for a latency heuristic
+    concurrent = sum(_counter_slots)
     
     # Latency increases with concurrent transactions
     latency_ms = BASE_WRITE_LATENCY_MS * (1 + concurrent * CONTENTION_FACTOR * 0.1)
@@ -71,16 +172,60 @@ def _simulate_write_latency():
 
 def _track_transaction_start():
     """Track when a transaction starts"""
-    global _active_transactions
-    with _transaction_lock:
-        _active_transactions += 1
+    # Only this thread ever writes its slot, so the update needs no lock
+    index = _slot_index()
+    _counter_slots[index] += 1
 
 
 def _track_transaction_end():
     """Track when a transaction ends"""
-    global _active_transactions
-    with _transaction_lock:
-        _active_transactions = max(0, _active_transactions - 1)
+    index = _slot_index()
+    _counter_slots[index] = max(0, _counter_slots[index] - 1)
+
+
+def _mark_payment_ready(payment_id: str):
+    """Wake anyone waiting for this payment intent to become ready for OTP"""
+    with _ready_lock:
+        _ready_events.setdefault(payment_id, threading.Event()).set()
+
+
+def release_payment_ready(payment_id: str):
+    """Forget a payment's readiness event once nothing needs to wait on it"""
+    payment_id = _as_object_id(payment_id)
+    with _ready_lock:
+        _ready_events.pop(payment_id, None)
+
+
+def is_payment_tracked(payment_id: str) -> bool:
+    """Whether a payment created here is still waiting for its OTP (its readiness event exists)"""
+    payment_id = _as_object_id(payment_id)
+    with _ready_lock:
+        return payment_id in _ready_events
+
+
+def _wait_payment_ready(payment_id: ObjectId, timeout_s: float):
+    """Block until the payment's creator signals it is ready, or the timeout passes"""
+    with _ready_lock:
+        ready = _ready_events.get(payment_id)
+    
+    # No event means the payment isn't tracked here (or was already released),
+    # so let the caller's lookup decide instead of burning the whole timeout
+    if ready is not None:
+        ready.wait(timeout_s)
+
+
+def _new_otp_session(payment_intent_id: str, otp_code: str, expiry_time: datetime, now: datetime) -> Dict[str, Any]:
+    """Build an OTP session document"""
+    return {
+        "_id": ObjectId(),
+        "payment_intent_id": _as_object_id(payment_intent_id),
+        "otp": otp_code,
+        "created_at": now,
+        "expires_at": expiry_time,
+        "expires_at_epoch": int((expiry_time - _EPOCH).total_seconds() * 1000),  # ms, for cheap expiry checks
+        "verified": False,
+        "failed": False
+    }
 
 
 def create_payment_intent(
@@ -97,128 +242,133 @@ def create_payment_intent(
     
     Returns the created payment intent document.
     """
-    db = get_db()
+    now = datetime.utcnow()
     
     payment_intent = {
-        "_id": str(uuid.uuid4()),
+        "_id": ObjectId(),
         "merchant_id": merchant_id,
         "amount": amount,
         "currency": currency,
         "card_last_four": card_last_four,
         "holder_name": holder_name,
-        "status": "pending",
-        "created_at": datetime.utcnow(),
+        "status": "awaiting_otp",  # Ready for OTP generation as soon as it lands
+        "created_at": now,
         "committed_at": None  # Will be set when OTP is verified
     }
     
     _track_transaction_start()
     try:
         _simulate_write_latency()
-        db.payment_intents.insert_one(payment_intent)
-        
-        # Mark as ready for OTP generation
-        payment_intent["status"] = "awaiting_otp"
-        db.payment_intents.update_one(
-            {"_id": payment_intent["_id"]},
-            {"$set": {"status": "awaiting_otp"}}
-        )
+        get_pool(merchant_id)[DATABASE_NAME].payment_intents.insert_one(payment_intent)
+        _mark_payment_ready(payment_intent["_id"])
     finally:
         _track_transaction_end()
     
     return payment_intent
 
 
-def get_payment_intent(payment_id: str, timeout_ms: int = 400) -> Optional[Dict[str, Any]]:
+def get_payment_intents(
+    payment_ids: List[str],
+    timeout_ms: int = 400,
+    projection: Optional[Dict[str, int]] = None
+) -> List[Optional[Dict[str, Any]]]:
     """
-    Get a payment intent by ID.
+    Get payment intents by ID.
     
     CRITICAL: This is used by OTP service and has a timeout.
     The timeout simulates real-world service timeouts.
     
-    Returns None if timeout exceeded or not found.
-    """
-    db = get_db()
-    start_time = time.time()
-    
-    # Wait for payment to be in 'awaiting_otp' status
-    # This creates a hidden dependency on the payment commit completing
-    while True:
-        elapsed_ms = (time.time() - start_time) * 1000
-        if elapsed_ms > timeout_ms:
-            return None  # Timeout - silent failure
-        
-        payment = db.payment_intents.find_one({
-            "_id": payment_id,
-            "status": {"$in": ["awaiting_otp", "otp_sent", "completed"]}
-        })
-        
-        if payment:
-            return payment
-        
-        # Small sleep to avoid tight polling
-        time.sleep(0.01)
-
-
-def create_otp_session(
-    payment_intent_id: str,
-    otp_code: str,
-    expiry_time: datetime
-) -> Dict[str, Any]:
-    """
-    Create an OTP session linked to a payment intent.
+    Waits for every payment against one shared deadline, then fetches them
+    all in a single query. Pass a projection (e.g. {"_id": 1}) when only
+    existence matters. Returns documents in input order, with None for
+    any payment that timed out or was not found.
     """
-    db = get_db()
+    _ensure_connected()
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    object_ids = [_as_object_id(payment_id) for payment_id in payment_ids]
     
-    session = {
-        "_id": str(uuid.uuid4()),
-        "payment_intent_id": payment_intent_id,
-        "otp": otp_code,
-        "created_at": datetime.utcnow(),
-        "expires_at": expiry_time,
-        "verified": False,
-        "failed": False
+    for payment_id in object_ids:
+        if payment_id is not None:
+            _wait_payment_ready(payment_id, max(0.0, deadline - time.monotonic()))
+    
+    found = {
+        doc["_id"]: doc
+        for doc in _payment_intents.find(
+            {"_id": {"$in": [oid for oid in object_ids if oid is not None]},
+             "status": {"$in": ["awaiting_otp", "otp_sent", "completed"]}},
+            projection
+        )
     }
+    return [found.get(oid) for oid in object_ids]
+
+
+def create_otp_sessions(
+    entries: List[Tuple[str, str, datetime]]
+) -> List[Dict[str, Any]]:
+    """
+    Create OTP sessions linked to their payment intents.
     
-    db.otp_sessions.insert_one(session)
+    entries are (payment_intent_id, otp_code, expiry_time) tuples. All
+    sessions go out in one insert_many and all status flips in one
+    update_many, so N OTPs cost two round-trips instead of 2N.
+    """
+    _ensure_connected()
+    now = datetime.utcnow()
+    sessions = [
+        _new_otp_session(payment_intent_id, otp_code, expiry_time, now)
+        for payment_intent_id, otp_code, expiry_time in entries
+    ]
+    if not sessions:
+        return sessions
+    payment_intent_ids = [session["payment_intent_id"] for session in sessions]
     
-    # Update payment intent status
-    db.payment_intents.update_one(
-        {"_id": payment_intent_id},
+    _otp_sessions.insert_many(sessions, ordered=False)
+    _payment_intents.update_many(
+        {"_id": {"$in": payment_intent_ids}},
         {"$set": {"status": "otp_sent"}}
     )
+    for payment_intent_id in payment_intent_ids:
+        release_payment_ready(payment_intent_id)
     
-    return session
+    return sessions
 
 
 def get_otp_session(session_id: str) -> Optional[Dict[str, Any]]:
     """Get OTP session by ID"""
-    db = get_db()
-    return db.otp_sessions.find_one({"_id": session_id})
+    _ensure_connected()
+    session_id = _as_object_id(session_id)
+    if session_id is None:
+        return None
+    return _otp_sessions.find_one({"_id": session_id})
 
 
 def verify_otp_session(session_id: str, success: bool) -> bool:
     """Mark OTP session as verified or failed"""
-    db = get_db()
+    _ensure_connected()
+    session_id = _as_object_id(session_id)
+    if session_id is None:
+        return False
+    now = datetime.utcnow()
     
-    result = db.otp_sessions.update_one(
+    # Flip the session and read back its payment intent in one round-trip
+    session = _otp_sessions.find_one_and_update(
         {"_id": session_id, "verified": False},
         {"$set": {
             "verified": True,
             "failed": not success,
-            "verified_at": datetime.utcnow()
-        }}
+            "verified_at": now
+        }},
+        projection={"payment_intent_id": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count > 0 and success:
-        # Get the session to find payment intent
-        session = db.otp_sessions.find_one({"_id": session_id})
-        if session:
-            db.payment_intents.update_one(
-                {"_id": session["payment_intent_id"]},
-                {"$set": {
-                    "status": "completed",
-                    "committed_at": datetime.utcnow()
-                }}
-            )
-    
-    return result.modified_count > 0
+    if session is not None and success:
+        _payment_intents.update_one(
+            {"_id": session["payment_intent_id"]},
+            {"$set": {
+                "status": "completed",
+                "committed_at": now
+            }}
+        )
+    
+    return session is not None
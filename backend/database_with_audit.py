@@ -1,60 +1,242 @@
 
 import time
-import uuid
+import queue
 import threading
-from datetime import datetime
-from typing import Optional, Dict, Any
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, WriteConcern
+from pymongo.errors import PyMongoError
 
-from config import MONGO_URI, DATABASE_NAME
+from config import (
+    MONGO_URI,
+    DATABASE_NAME,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_POOL_SHARDS,
+    AUDIT_FLUSH_SIZE,
+    AUDIT_FLUSH_INTERVAL_MS,
+    MAX_DB_BATCH_SIZE
+)
 
-_db_lock = threading.Lock()
-_active_writes = 0
-_writes_lock = threading.Lock()
+_write_slots = []
+_slot_local = threading.local()
+_slot_register_lock = threading.Lock()
+_ready_events: Dict[str, threading.Event] = {}
+_ready_lock = threading.Lock()
+_EPOCH = datetime(1970, 1, 1)
+_audit_queue = queue.Queue()
+_AUDIT_TICK = timedelta(microseconds=1)
+_audit_writer = None
+_audit_writer_lock = threading.Lock()
+_POOL_SLICES = MONGO_POOL_SHARDS + 1
+_SLICE_MAX_POOL_SIZE = max(1, MONGO_MAX_POOL_SIZE // _POOL_SLICES)
+_SLICE_MIN_POOL_SIZE = MONGO_MIN_POOL_SIZE // _POOL_SLICES
+_connect_lock = threading.Lock()
+_payment_intents = None
+_otp_sessions = None
+_audit_logs = None
+
+
+def _new_client(max_pool_size: int, min_pool_size: int) -> MongoClient:
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        retryWrites=True
+    )
 
 
 class DatabaseConnection:
     _instance = None
     _client = None
+    _shard_clients = []
     _db = None
+    _audit_logs = None
     
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._client = MongoClient(MONGO_URI)
-            cls._db = cls._client[DATABASE_NAME]
+            with _connect_lock:
+                if cls._instance is None:
+                    cls._connect()
         return cls._instance
     
+    @classmethod
+    def _connect(cls):
+        global _payment_intents, _otp_sessions, _audit_logs
+        cls._client = _new_client(_SLICE_MAX_POOL_SIZE, _SLICE_MIN_POOL_SIZE)
+        cls._shard_clients = [
+            _new_client(_SLICE_MAX_POOL_SIZE, _SLICE_MIN_POOL_SIZE)
+            for _ in range(MONGO_POOL_SHARDS)
+        ]
+        cls._db = cls._client[DATABASE_NAME]
+        # Audit entries are non-authoritative: fire-and-forget, no ack round-trip
+        cls._audit_logs = cls._db.get_collection(
+            "audit_logs", write_concern=WriteConcern(w=0)
+        )
+        _payment_intents = cls._db.payment_intents
+        _otp_sessions = cls._db.otp_sessions
+        _audit_logs = cls._audit_logs
+        cls._instance = super().__new__(cls)
+    
     @property
     def db(self):
         return self._db
+    
+    @property
+    def shard_clients(self):
+        return self._shard_clients
+    
+    @property
+    def audit_logs(self):
+        return self._audit_logs
 
 
 def get_db():
     return DatabaseConnection().db
 
 
+def get_pool(key: str) -> MongoClient:
+    return DatabaseConnection().shard_clients[hash(key) % MONGO_POOL_SHARDS]
+
+
+def warmup(connections: int = MONGO_MIN_POOL_SIZE):
+    per_client = max(1, connections // _POOL_SLICES)
+    with ThreadPoolExecutor(max_workers=per_client) as pool:
+        for client in [get_db().client] + DatabaseConnection().shard_clients:
+            list(pool.map(client.admin.command, ["ping"] * per_client))
+
+
+def _ensure_connected():
+    if _otp_sessions is None:
+        DatabaseConnection()
+
+
+def _as_object_id(value: Any) -> Optional[ObjectId]:
+    """Coerce an id that crossed the API boundary as a string back to an ObjectId"""
+    if isinstance(value, ObjectId):
+        return value
+    return ObjectId(value) if ObjectId.is_valid(value) else None
+
+
+def _slot_index() -> int:
+    """Get this thread's private write-counter slot, registering it on first use"""
+    try:
+        return _slot_local.index
+    except AttributeError:
+        with _slot_register_lock:
+            _write_slots.append(0)
+            _slot_local.index = len(_write_slots) - 1
+        return _slot_local.index
+
+
 def _start_write():
     """Track active writes for contention simulation"""
-    global _active_writes
-    with _writes_lock:
-        _active_writes += 1
-        return _active_writes
+    # Only this thread ever writes its slot, so the update needs no lock
+    index = _slot_index()
+    _write_slots[index] += 1
+    return sum(_write_slots)
 
 
 def _end_write():
     """End write tracking"""
-    global _active_writes
-    with _writes_lock:
-        _active_writes = max(0, _active_writes - 1)
+    index = _slot_index()
+    _write_slots[index] = max(0, _write_slots[index] - 1)
 
 
 def _get_contention_delay():
     
-    global _active_writes
-    with _writes_lock:
-        
-        return _active_writes * 50
+    return sum(_write_slots) * 50
+
+
+def _drain_audit_queue():
+    """Write queued audit entries in batches, off the request path"""
+    _ensure_connected()
+    flush_interval = AUDIT_FLUSH_INTERVAL_MS / 1000.0
+    batch_limit = MAX_DB_BATCH_SIZE if MAX_DB_BATCH_SIZE > 0 else 1
+    while True:
+        batch = [_audit_queue.get()]
+        deadline = time.monotonic() + flush_interval
+        while len(batch) < batch_limit:
+            # Wait for more until the flush threshold, then only take what is queued
+            timeout = deadline - time.monotonic() if len(batch) < AUDIT_FLUSH_SIZE else 0
+            try:
+                if timeout > 0:
+                    batch.append(_audit_queue.get(timeout=timeout))
+                else:
+                    batch.append(_audit_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if len(batch) == 1:
+                _audit_logs.insert_one(batch[0])
+            else:
+                _audit_logs.insert_many(batch, ordered=False)
+        except PyMongoError:
+            pass  # Audit logging is best-effort; keep the writer alive
+
+
+def _enqueue_audit(entry: Dict[str, Any]):
+    """Queue an audit entry for the background writer"""
+    global _audit_writer
+    if _audit_writer is None:
+        with _audit_writer_lock:
+            if _audit_writer is None:
+                _audit_writer = threading.Thread(
+                    target=_drain_audit_queue, name="audit-writer", daemon=True
+                )
+                _audit_writer.start()
+    _audit_queue.put(entry)
+
+
+def _mark_payment_ready(payment_id: str):
+    """Wake anyone waiting for this payment intent to become ready for OTP"""
+    with _ready_lock:
+        _ready_events.setdefault(payment_id, threading.Event()).set()
+
+
+def release_payment_ready(payment_id: str):
+    """Forget a payment's readiness event once nothing needs to wait on it"""
+    payment_id = _as_object_id(payment_id)
+    with _ready_lock:
+        _ready_events.pop(payment_id, None)
+
+
+def is_payment_tracked(payment_id: str) -> bool:
+    """Whether a payment created here is still waiting for its OTP (its readiness event exists)"""
+    payment_id = _as_object_id(payment_id)
+    with _ready_lock:
+        return payment_id in _ready_events
+
+
+def _wait_payment_ready(payment_id: ObjectId, timeout_s: float):
+    """Block until the payment's creator signals it is ready, or the timeout passes"""
+    with _ready_lock:
+        ready = _ready_events.get(payment_id)
+    
+    if ready is not None:
+        ready.wait(timeout_s)
+
+
+def _new_otp_session(payment_intent_id: str, otp_code: str, expiry_time: datetime, now: datetime) -> Dict[str, Any]:
+    """Build an OTP session document"""
+    return {
+        "_id": ObjectId(),
+        "payment_intent_id": _as_object_id(payment_intent_id),
+        "otp": otp_code,
+        "created_at": now,
+        "expires_at": expiry_time,
+        "expires_at_epoch": int((expiry_time - _EPOCH).total_seconds() * 1000),
+        "verified": False,
+        "failed": False
+    }
 
 
 def create_payment_intent(
@@ -65,9 +247,9 @@ def create_payment_intent(
     holder_name: str
 ) -> Dict[str, Any]:
     
-    db = get_db()
+    now = datetime.utcnow()
     
-    payment_id = str(uuid.uuid4())
+    payment_id = ObjectId()
     
     payment_intent = {
         "_id": payment_id,
@@ -76,8 +258,8 @@ def create_payment_intent(
         "currency": currency,
         "card_last_four": card_last_four,
         "holder_name": holder_name,
-        "status": "pending",
-        "created_at": datetime.utcnow(),
+        "status": "awaiting_otp",
+        "created_at": now,
         "committed_at": None
     }
     
@@ -88,100 +270,104 @@ def create_payment_intent(
         if contention_delay > 0:
             time.sleep(contention_delay / 1000.0)
         
-        # Insert payment
-        db.payment_intents.insert_one(payment_intent)
+        # Insert payment, already in its awaiting_otp state
+        get_pool(merchant_id)[DATABASE_NAME].payment_intents.insert_one(payment_intent)
+        _mark_payment_ready(payment_id)
         
-       
-        time.sleep(0.1)
-        db.audit_logs.insert_one({
-            "_id": str(uuid.uuid4()),
+        
+        # Audit entries are written by the background writer
+        _enqueue_audit({
+            "_id": ObjectId(),
             "payment_id": payment_id,
             "action": "created",
-            "timestamp": datetime.utcnow()
+            "timestamp": now
         })
-        
-        
-        time.sleep(0.05)
-        db.payment_intents.update_one(
-            {"_id": payment_id},
-            {"$set": {"status": "awaiting_otp"}}
-        )
-        payment_intent["status"] = "awaiting_otp"
-        
-        
-        time.sleep(0.1)
-        db.audit_logs.insert_one({
-            "_id": str(uuid.uuid4()),
+        _enqueue_audit({
+            "_id": ObjectId(),
             "payment_id": payment_id,
             "action": "status_changed",
-            "timestamp": datetime.utcnow()
+            "timestamp": now + _AUDIT_TICK  # Keeps the two entries ordered
         })
-        
-        
     finally:
         _end_write()
     
     return payment_intent
 
 
-def get_payment_intent(payment_id: str, timeout_ms: int = 400) -> Optional[Dict[str, Any]]:
-   
-    db = get_db()
-    start = time.time()
+def get_payment_intents(
+    payment_ids: List[str],
+    timeout_ms: int = 400,
+    projection: Optional[Dict[str, int]] = None
+) -> List[Optional[Dict[str, Any]]]:
+    _ensure_connected()
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    object_ids = [_as_object_id(payment_id) for payment_id in payment_ids]
     
-    while (time.time() - start) * 1000 < timeout_ms:
-        payment = db.payment_intents.find_one({
-            "_id": payment_id,
-            "status": {"$in": ["awaiting_otp", "otp_sent", "completed"]}
-        })
-        if payment:
-            return payment
-        time.sleep(0.01)
+    for payment_id in object_ids:
+        if payment_id is not None:
+            _wait_payment_ready(payment_id, max(0.0, deadline - time.monotonic()))
     
-   
-    return None
+    found = {
+        doc["_id"]: doc
+        for doc in _payment_intents.find(
+            {"_id": {"$in": [oid for oid in object_ids if oid is not None]},
+             "status": {"$in": ["awaiting_otp", "otp_sent", "completed"]}},
+            projection
+        )
+    }
+    return [found.get(oid) for oid in object_ids]
 
 
-def create_otp_session(payment_intent_id: str, otp_code: str, expiry_time: datetime) -> Dict[str, Any]:
-    db = get_db()
+def create_otp_sessions(
+    entries: List[Tuple[str, str, datetime]]
+) -> List[Dict[str, Any]]:
+    _ensure_connected()
+    now = datetime.utcnow()
+    sessions = [
+        _new_otp_session(payment_intent_id, otp_code, expiry_time, now)
+        for payment_intent_id, otp_code, expiry_time in entries
+    ]
+    if not sessions:
+        return sessions
+    payment_intent_ids = [session["payment_intent_id"] for session in sessions]
     
-    session = {
-        "_id": str(uuid.uuid4()),
-        "payment_intent_id": payment_intent_id,
-        "otp": otp_code,
-        "created_at": datetime.utcnow(),
-        "expires_at": expiry_time,
-        "verified": False,
-        "failed": False
-    }
-    
-    db.otp_sessions.insert_one(session)
-    db.payment_intents.update_one(
-        {"_id": payment_intent_id},
+    _otp_sessions.insert_many(sessions, ordered=False)
+    _payment_intents.update_many(
+        {"_id": {"$in": payment_intent_ids}},
         {"$set": {"status": "otp_sent"}}
     )
+    for payment_intent_id in payment_intent_ids:
+        release_payment_ready(payment_intent_id)
     
-    return session
+    return sessions
 
 
 def get_otp_session(session_id: str) -> Optional[Dict[str, Any]]:
-    return get_db().otp_sessions.find_one({"_id": session_id})
+    _ensure_connected()
+    session_id = _as_object_id(session_id)
+    if session_id is None:
+        return None
+    return _otp_sessions.find_one({"_id": session_id})
 
 
 def verify_otp_session(session_id: str, success: bool) -> bool:
-    db = get_db()
+    _ensure_connected()
+    session_id = _as_object_id(session_id)
+    if session_id is None:
+        return False
+    now = datetime.utcnow()
     
-    result = db.otp_sessions.update_one(
+    session = _otp_sessions.find_one_and_update(
         {"_id": session_id, "verified": False},
-        {"$set": {"verified": True, "failed": not success, "verified_at": datetime.utcnow()}}
+        {"$set": {"verified": True, "failed": not success, "verified_at": now}},
+        projection={"payment_intent_id": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count > 0 and success:
-        session = db.otp_sessions.find_one({"_id": session_id})
-        if session:
-            db.payment_intents.update_one(
-                {"_id": session["payment_intent_id"]},
-                {"$set": {"status": "completed", "committed_at": datetime.utcnow()}}
-            )
+    if session is not None and success:
+        _payment_intents.update_one(
+            {"_id": session["payment_intent_id"]},
+            {"$set": {"status": "completed", "committed_at": now}}
+        )
     
-    return result.modified_count > 0
+    return session is not None
@@ -8,7 +8,26 @@ import time
 import random
 from dataclasses import dataclass
 from typing import List
-import statistics
+
+import numpy as np
+
+
+# Built once; LoadTestResult.__str__ only fills in the numbers
+_RESULTS_BANNER = """
+╔════════════════════════════════════════════╗
+║         LOAD TEST RESULTS                  ║
+╠════════════════════════════════════════════╣
+║ Total Requests:        {total_requests:>8}             ║
+║ Successful Payments:   {successful_payments:>8}             ║
+║ Failed OTP Generation: {failed_otp_generation:>8}             ║
+║ Other Failures:        {other_failures:>8}             ║
+╠════════════════════════════════════════════╣
+║ OTP Success Rate:      {otp_success_rate:>7.1f}%            ║
+║ Avg Latency:           {avg_latency_ms:>7.1f}ms           ║
+║ P95 Latency:           {p95_latency_ms:>7.1f}ms           ║
+║ P99 Latency:           {p99_latency_ms:>7.1f}ms           ║
+╚════════════════════════════════════════════╝
+"""
 
 
 @dataclass
@@ -24,21 +43,7 @@ class LoadTestResult:
     otp_success_rate: float
     
     def __str__(self):
-        return f"""
-╔════════════════════════════════════════════╗
-║         LOAD TEST RESULTS                  ║
-╠════════════════════════════════════════════╣
-║ Total Requests:        {self.total_requests:>8}             ║
-║ Successful Payments:   {self.successful_payments:>8}             ║
-║ Failed OTP Generation: {self.failed_otp_generation:>8}             ║
-║ Other Failures:        {self.other_failures:>8}             ║
-╠════════════════════════════════════════════╣
-║ OTP Success Rate:      {self.otp_success_rate:>7.1f}%            ║
-║ Avg Latency:           {self.avg_latency_ms:>7.1f}ms           ║
-║ P95 Latency:           {self.p95_latency_ms:>7.1f}ms           ║
-║ P99 Latency:           {self.p99_latency_ms:>7.1f}ms           ║
-╚════════════════════════════════════════════╝
-"""
+        return _RESULTS_BANNER.format_map(vars(self))
 
 
 async def make_payment_request(
@@ -107,54 +112,74 @@ async def run_load_test(
     results: List[dict] = []
     
     async with aiohttp.ClientSession() as session:
-        # Create batches of requests
-        batches = []
-        for i in range(0, total_requests, concurrency):
-            batch_size = min(concurrency, total_requests - i)
-            
-            # Add burstiness - some batches have higher concurrency
-            if burst_enabled and random.random() < 0.3:
-                batch_size = min(batch_size * 2, total_requests - i)
+        # Keep up to `concurrency` requests in flight instead of waiting
+        # for a whole batch, so one slow request can't stall the pipeline
+        in_flight = asyncio.Semaphore(concurrency)
+        
+        async def bounded_request(request_id: int, gated: bool):
+            try:
+                result = await make_payment_request(session, base_url, request_id)
+            finally:
+                if gated:
+                    in_flight.release()
+            results.append(result)
             
-            batches.append((i, batch_size))
+            # Progress indicator
+            print(f"  Progress: {len(results)}/{total_requests}", end="\r")
         
-        for batch_start, batch_size in batches:
-            # Create concurrent requests for this batch
-            tasks = [
-                make_payment_request(session, base_url, batch_start + j)
-                for j in range(batch_size)
-            ]
+        tasks = []
+        for wave_start in range(0, total_requests, concurrency):
+            wave_size = min(concurrency, total_requests - wave_start)
             
-            batch_results = await asyncio.gather(*tasks)
-            results.extend(batch_results)
+            # Add burstiness - some waves are launched on top of the
+            # requests already in flight, briefly doubling concurrency
+            burst = burst_enabled and random.random() < 0.3
             
-            # Small delay between batches
+            for j in range(wave_size):
+                if not burst:
+                    await in_flight.acquire()
+                tasks.append(asyncio.create_task(
+                    bounded_request(wave_start + j, gated=not burst)
+                ))
+            
+            # Small delay between waves
             if burst_enabled:
                 await asyncio.sleep(random.uniform(0.01, 0.1))
             else:
                 await asyncio.sleep(0.05)
-            
-            # Progress indicator
-            print(f"  Progress: {len(results)}/{total_requests}", end="\r")
+        
+        await asyncio.gather(*tasks)
     
     print()  # New line after progress
     
-    # Calculate statistics
-    successful = sum(1 for r in results if r["success"])
-    otp_failed = sum(1 for r in results if not r["otp_generated"] and "OTP" in r.get("message", ""))
-    other_failed = sum(1 for r in results if not r["success"] and "OTP" not in r.get("message", ""))
+    # Calculate statistics in a single pass over the results
+    successful = otp_failed = other_failed = 0
+    for r in results:
+        otp_message = "OTP" in r.get("message", "")
+        if r["success"]:
+            successful += 1
+        elif not otp_message:
+            other_failed += 1
+        if otp_message and not r["otp_generated"]:
+            otp_failed += 1
     
-    latencies = [r["latency_ms"] for r in results]
-    latencies.sort()
+    latencies = np.fromiter(
+        (r["latency_ms"] for r in results), dtype=np.float64, count=len(results)
+    )
+    if latencies.size:
+        p95, p99 = np.percentile(latencies, [95, 99])
+        avg = latencies.mean()
+    else:
+        p95 = p99 = avg = 0
     
     return LoadTestResult(
         total_requests=len(results),
         successful_payments=successful,
         failed_otp_generation=otp_failed,
         other_failures=other_failed,
-        avg_latency_ms=statistics.mean(latencies) if latencies else 0,
-        p95_latency_ms=latencies[int(len(latencies) * 0.95)] if latencies else 0,
-        p99_latency_ms=latencies[int(len(latencies) * 0.99)] if latencies else 0,
+        avg_latency_ms=float(avg),
+        p95_latency_ms=float(p95),
+        p99_latency_ms=float(p99),
         otp_success_rate=(successful / len(results) * 100) if results else 0
     )
 
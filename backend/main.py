@@ -4,6 +4,7 @@ Demo payment processing with OTP verification
 
 ARCHITECTURE:
 - Payment Service: Creates payment intents, calls OTP service synchronously
+  (or queues OTP generation for a worker pool via /payment/initiate-async)
 - OTP Service: Generates OTPs with strict timeout (400ms)
 - Database: MongoDB with payment_intents and otp_sessions collections
 
@@ -13,27 +14,83 @@ If payment creation is slow (due to DB contention), OTP generation times out.
 This timeout is SILENT - the payment appears to fail with a generic error.
 """
 
+import json
+import logging
 import os
-from typing import Optional
+import queue
+import re
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Annotated, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, StringConstraints, field_validator
 from dotenv import load_dotenv
+from prometheus_client import make_asgi_app
 
 import payment_service
 import otp_service
+from config import LOG_LEVEL
 
 # Load environment variables
 load_dotenv()
 
+# Structured logging: one JSON object per line, with the `extra` fields
+# payment_service attaches (phase, duration_ms, attempt, result) merged in
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON"""
+    def format(self, record):
+        event = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage()
+        }
+        event.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in _LOG_RECORD_ATTRS
+        )
+        return json.dumps(event, default=str)
+
+
+# Requests only enqueue their log records; the listener thread formats and
+# writes them, so stream I/O never blocks the event loop
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonFormatter())
+_log_listener = QueueListener(_log_queue, _log_handler)
+payment_service.logger.addHandler(QueueHandler(_log_queue))
+payment_service.logger.setLevel(LOG_LEVEL)
+payment_service.logger.propagate = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm the database pool and run the OTP worker pool (and log writer) for the app's lifetime"""
+    _log_listener.start()
+    await payment_service.warmup()
+    payment_service.start_otp_workers()
+    yield
+    await payment_service.stop_otp_workers()
+    # Flushes whatever is still queued
+    _log_listener.stop()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Payment Gateway",
     description="Demo payment processing with OTP verification",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
+# Prometheus metrics (payment phase latency histograms)
+app.mount("/metrics", make_asgi_app())
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -46,46 +103,33 @@ app.add_middleware(
 
 # ============= Request/Response Models =============
 
+# Precompiled once so the card validator stays in the C regex engine per request
+_CARD_STRIP = str.maketrans("", "", " -")
+_CARD_RE = re.compile(r"\d{13,19}")
+
+# Pattern constraints are compiled into the model and enforced by pydantic-core
+CardNumber = Annotated[str, StringConstraints(pattern=r"^[\d\s-]{13,25}$")]
+Expiry = Annotated[str, StringConstraints(pattern=r"^(0[1-9]|1[0-2])/\d{2}$")]
+Cvv = Annotated[str, StringConstraints(pattern=r"^\d{3,4}$")]
+
+
 class PaymentInitiateRequest(BaseModel):
     """Request for initiating a payment"""
-    card_number: str
-    expiry: str
-    cvv: str
+    card_number: CardNumber
+    expiry: Expiry
+    cvv: Cvv
     holder_name: str
     amount: float = 100.00
     currency: str = "USD"
     merchant_id: str = "demo_merchant"
     
-    @validator("card_number")
+    @field_validator("card_number")
+    @classmethod
     def validate_card_number(cls, v):
-        cleaned = v.replace(" ", "").replace("-", "")
-        if not cleaned.isdigit():
-            raise ValueError("Card number must contain only digits")
-        if not (13 <= len(cleaned) <= 19):
+        cleaned = v.translate(_CARD_STRIP)
+        if not _CARD_RE.fullmatch(cleaned):
             raise ValueError("Card number must be 13-19 digits")
         return cleaned
-    
-    @validator("expiry")
-    def validate_expiry(cls, v):
-        if "/" not in v:
-            raise ValueError("Expiry must be in MM/YY format")
-        parts = v.split("/")
-        if len(parts) != 2:
-            raise ValueError("Expiry must be in MM/YY format")
-        month, year = parts
-        if not (month.isdigit() and year.isdigit()):
-            raise ValueError("Expiry must contain only digits")
-        if not (1 <= int(month) <= 12):
-            raise ValueError("Month must be between 01 and 12")
-        return v
-    
-    @validator("cvv")
-    def validate_cvv(cls, v):
-        if not v.isdigit():
-            raise ValueError("CVV must contain only digits")
-        if not (3 <= len(v) <= 4):
-            raise ValueError("CVV must be 3-4 digits")
-        return v
 
 
 class PaymentInitiateResponse(BaseModel):
@@ -97,6 +141,15 @@ class PaymentInitiateResponse(BaseModel):
     payment_id: Optional[str] = None
 
 
+class OTPStatusResponse(BaseModel):
+    """OTP status for an asynchronously initiated payment"""
+    status: str  # pending, ready, failed or unknown
+    message: str
+    session_id: Optional[str] = None
+    otp: Optional[str] = None  # For demo only
+    payment_id: str
+
+
 class OTPVerifyRequest(BaseModel):
     """Request for OTP verification"""
     session_id: str
@@ -155,7 +208,7 @@ async def initiate_payment(request: PaymentInitiateRequest):
     to fail silently. The response will show success=False with
     a generic "Unable to generate OTP" message.
     """
-    result = payment_service.initiate_payment(
+    result = await payment_service.initiate_payment(
         merchant_id=request.merchant_id,
         card_number=request.card_number,
         expiry=request.expiry,
@@ -174,6 +227,62 @@ async def initiate_payment(request: PaymentInitiateRequest):
     )
 
 
+@app.post("/payment/initiate-async", response_model=PaymentInitiateResponse, status_code=202)
+async def initiate_payment_async(request: PaymentInitiateRequest, response: Response):
+    """
+    Initiate a payment and generate its OTP in the background.
+    
+    Returns 202 with the payment_id as soon as the payment intent is
+    stored; poll GET /payment/{payment_id}/otp for the OTP. OTP retries
+    happen in the worker pool, off the request path.
+    
+    Returns 503 when the OTP queue is full.
+    """
+    try:
+        result = await payment_service.enqueue_payment(
+            merchant_id=request.merchant_id,
+            card_number=request.card_number,
+            expiry=request.expiry,
+            cvv=request.cvv,
+            holder_name=request.holder_name,
+            amount=request.amount,
+            currency=request.currency
+        )
+    except payment_service.OTPQueueFullError:
+        raise HTTPException(status_code=503, detail="OTP queue is full, please retry")
+    
+    if not result.success:
+        # Nothing was queued
+        response.status_code = 200
+    
+    return PaymentInitiateResponse(
+        success=result.success,
+        message=result.message,
+        payment_id=result.payment_id
+    )
+
+
+@app.get("/payment/{payment_id}/otp", response_model=OTPStatusResponse)
+async def get_payment_otp(payment_id: str):
+    """
+    Poll the OTP for a payment from /payment/initiate-async.
+    
+    Status is pending until a worker finishes, then ready or failed.
+    """
+    status, result = payment_service.get_otp_result(payment_id)
+    if result is None:
+        message = "OTP pending" if status == "pending" else "Unknown payment"
+        return OTPStatusResponse(status=status, message=message, payment_id=payment_id)
+    
+    return OTPStatusResponse(
+        status=status,
+        message=result.message,
+        session_id=result.session_id,
+        otp=result.otp,
+        payment_id=payment_id
+    )
+
+
 @app.post("/payment/verify-otp", response_model=OTPVerifyResponse)
 async def verify_otp(request: OTPVerifyRequest):
     """
@@ -0,0 +1,154 @@
+"""
+OTP Batcher for Payment Gateway
+Coalesces concurrent OTP creations into one database round-trip
+"""
+import asyncio
+from typing import Any, List, Optional, Set, Tuple
+
+from circuit_breaker import CircuitBreaker
+import otp_service
+
+
+class BatchedOTPCreator:
+    """
+    Micro-batches OTP creation.
+
+    submit() queues a payment and waits on its own future. A background
+    task collects whatever arrives within `window_ms` (up to `max_batch`
+    payments) and creates all of their OTP sessions with one
+    insert_many, so N concurrent OTPs hold a pooled connection once
+    instead of N times.
+
+    Given a breaker, each flush records one outcome on it - it is one
+    call to the OTP service, however many payments rode along - so a
+    single failed write can't count as N consecutive failures. Callers
+    only use their own result to decide whether to retry.
+    """
+
+    def __init__(
+        self,
+        max_batch: int = 64,
+        window_ms: float = 5,
+        breaker: Optional[CircuitBreaker] = None
+    ):
+        self.max_batch = max_batch
+        self.window_ms = window_ms
+        self.breaker = breaker
+
+        # Created with the collector, in the loop it runs on
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        payment_intent_id: Any
+    ) -> Tuple[Optional[str], Optional[str], Optional[otp_service.OTPError]]:
+        """
+        Generate an OTP for one payment as part of the next batch.
+
+        Returns this payment's (session_id, otp_code, error) tuple from
+        otp_service.create_otp_for_payments.
+        """
+        # Started lazily so it binds to the loop that is actually serving
+        # requests; asyncio queues can't cross loops, so it gets a fresh one
+        loop = asyncio.get_running_loop()
+        if self._collector is None or self._collector.done() or self._collector.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._collector = asyncio.create_task(self._collect(self._queue))
+
+        future = loop.create_future()
+        self._queue.put_nowait((payment_intent_id, future))
+        return await future
+
+    async def close(self):
+        """Stop collecting and wait for batches already at the database"""
+        if self._collector is not None:
+            self._collector.cancel()
+            await asyncio.gather(self._collector, return_exceptions=True)
+            self._collector = None
+
+        # Nobody will batch what's still queued (a collector cancelled before
+        # it first ran never got to fail these itself)
+        if self._queue is not None:
+            _fail_all(self._queue, [], asyncio.CancelledError())
+            self._queue = None
+
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def _collect(self, queue: asyncio.Queue):
+        """Group queued payments into batches and hand each one off"""
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = loop.time() + self.window_ms / 1000.0
+
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Flush in the background so the next batch can start filling
+                # while this one waits on the database
+                task = asyncio.create_task(self._flush(batch))
+                self._flushes.add(task)
+                task.add_done_callback(self._flushes.discard)
+                batch = []
+        except BaseException as e:
+            # Closing or crashing: don't leave any caller waiting forever
+            _fail_all(queue, batch, e)
+            raise
+
+    async def _flush(self, batch: List[Tuple[Any, asyncio.Future]]):
+        """Create OTPs for a batch and resolve each caller's future"""
+        try:
+            results = await asyncio.to_thread(
+                otp_service.create_otp_for_payments,
+                [payment_intent_id for payment_intent_id, _ in batch]
+            )
+        except Exception as e:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.breaker is not None:
+            self._record_outcome(results)
+
+        for (_, future), result in zip(batch, results):
+            # Callers that gave up (cancelled) no longer care about the result
+            if not future.done():
+                future.set_result(result)
+
+    def _record_outcome(self, results):
+        """
+        Record the flush on the breaker: any OTP issued means the service
+        works; otherwise any retryable error is a failure. A batch of only
+        terminal errors says nothing about the service and records nothing.
+        """
+        errors = [error for _, _, error in results]
+        if any(error is None for error in errors):
+            self.breaker.record_success()
+        elif any(error.kind in otp_service.RETRYABLE_OTP_ERRORS for error in errors):
+            self.breaker.record_failure()
+
+
+def _fail_all(queue: asyncio.Queue, batch: List[Tuple[Any, asyncio.Future]], error: BaseException):
+    """Resolve every future in batch and still in queue with error (cancelled on CancelledError)"""
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    for _, future in batch:
+        if future.done():
+            continue
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
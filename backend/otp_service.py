@@ -2,76 +2,113 @@
 OTP Service for Payment Gateway
 Handles OTP generation with strict timeout requirements
 """
-import random
-import string
+import secrets
 import time
 from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from typing import List, NamedTuple, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
 from config import OTP_EXPIRY_MINUTES, OTP_TIMEOUT_MS
 import database
 
 
-def generate_otp_code() -> str:
-    """Generate a random 6-digit OTP code"""
-    return "".join(random.choices(string.digits, k=6))
+# OTP error kinds worth retrying; anything else fails the same way again
+RETRYABLE_OTP_ERRORS = {"timeout", "db"}
+
 
+class OTPError(NamedTuple):
+    """Structured OTP failure, so callers can tell retryable errors from terminal ones"""
+    kind: str  # "timeout", "db", "validation", "duplicate" or "not_found"
+    message: str
 
-def generate_session_id() -> str:
-    """Generate a unique session ID"""
-    return "".join(random.choices(string.ascii_uppercase + string.digits, k=16))
 
+def generate_otp_code() -> str:
+    """Generate a random 6-digit OTP code"""
+    return f"{secrets.randbelow(1_000_000):06d}"
 
-def create_otp_for_payment(payment_intent_id: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+
+def create_otp_for_payments(
+    payment_intent_ids: List[str]
+) -> List[Tuple[Optional[str], Optional[str], Optional[OTPError]]]:
     """
-    Generate OTP for a payment intent.
+    Generate OTPs for a batch of payment intents.
     
     CRITICAL: This function has a strict timeout (OTP_TIMEOUT_MS).
-    It waits for the payment intent to be in a valid state before generating OTP.
+    It waits for the payment intents to be in a valid state before generating OTPs.
     
     This creates a HIDDEN DEPENDENCY:
     - If payment creation takes too long, this times out
     - The timeout is silent (no crash, no loud error)
     - Caller receives None values indicating failure
     
+    All the intents share one OTP_TIMEOUT_MS budget and their OTP sessions
+    are created in a single multi-document write.
+    
     Returns:
-        Tuple of (session_id, otp_code, error_message)
+        One (session_id, otp_code, error) tuple per input, in order
         - On success: (session_id, otp_code, None)
-        - On timeout: (None, None, None) - SILENT FAILURE
-        - On error: (None, None, error_message)
+        - On timeout: (None, None, OTPError("timeout", ...)) - still SILENT to the user
+        - On error: (None, None, OTPError(kind, message)) where kind is
+          "db" (retryable), "duplicate", "validation" or "not_found" (terminal)
     """
     start_time = time.time()
     
-    # Wait for payment intent to be ready
-    # This polls the database with the configured timeout
-    payment = database.get_payment_intent(payment_intent_id, timeout_ms=OTP_TIMEOUT_MS)
+    try:
+        payments = database.get_payment_intents(
+            payment_intent_ids,
+            timeout_ms=OTP_TIMEOUT_MS,
+            projection={"_id": 1}
+        )
+    except Exception as e:
+        return [(None, None, _classify_error(e))] * len(payment_intent_ids)
     
     elapsed_ms = (time.time() - start_time) * 1000
+    # A missing payment nobody here is waiting on doesn't exist (terminal);
+    # one that is still tracked just wasn't ready in time (retryable)
+    results = [
+        (None, None, OTPError("timeout", "Payment intent not ready in time"))
+        if payment is not None or database.is_payment_tracked(payment_intent_id)
+        else (None, None, OTPError("not_found", "Payment intent not found"))
+        for payment_intent_id, payment in zip(payment_intent_ids, payments)
+    ]
     
-    if payment is None:
-        # Timeout or not found - SILENT FAILURE
-        # This is the critical failure point that's hard to debug
-        return None, None, None
-    
-    # Check if we still have time to complete
-    remaining_ms = OTP_TIMEOUT_MS - elapsed_ms
-    if remaining_ms < 50:  # Need at least 50ms to create OTP session
-        return None, None, None
+    if OTP_TIMEOUT_MS - elapsed_ms < 50:
+        out_of_time = (None, None, OTPError("timeout", "Not enough time left to create OTP session"))
+        return [
+            result if payment is None else out_of_time
+            for payment, result in zip(payments, results)
+        ]
     
-    # Generate OTP
-    session_id = generate_session_id()
-    otp_code = generate_otp_code()
+    # Only payments that are ready get an OTP; the rest keep their error
     expiry_time = datetime.utcnow() + timedelta(minutes=OTP_EXPIRY_MINUTES)
+    ready = [i for i, payment in enumerate(payments) if payment is not None]
+    otp_codes = [generate_otp_code() for _ in ready]
     
     try:
-        database.create_otp_session(
-            payment_intent_id=payment_intent_id,
-            otp_code=otp_code,
-            expiry_time=expiry_time
-        )
-        return session_id, otp_code, None
+        sessions = database.create_otp_sessions([
+            (payment_intent_ids[i], otp_code, expiry_time)
+            for i, otp_code in zip(ready, otp_codes)
+        ])
     except Exception as e:
-        return None, None, str(e)
+        error = _classify_error(e)
+        for i in ready:
+            results[i] = (None, None, error)
+        return results
+    
+    for i, otp_code, session in zip(ready, otp_codes, sessions):
+        results[i] = (str(session["_id"]), otp_code, None)
+    return results
+
+
+def _classify_error(e: Exception) -> OTPError:
+    """Map an exception from the payment lookup or OTP session creation to an OTPError"""
+    if isinstance(e, DuplicateKeyError):
+        return OTPError("duplicate", str(e))
+    if isinstance(e, PyMongoError):
+        return OTPError("db", str(e))
+    # Anything else is deterministic (bad input) and won't succeed on retry
+    return OTPError("validation", str(e))
 
 
 def verify_otp(session_id: str, otp_code: str) -> Tuple[bool, str]:
@@ -89,7 +126,8 @@ def verify_otp(session_id: str, otp_code: str) -> Tuple[bool, str]:
     if session.get("verified"):
         return False, "OTP already used"
     
-    if datetime.utcnow() > session["expires_at"]:
+    # Integer compare against the stored epoch millis - no datetime allocation
+    if int(time.time() * 1000) > session["expires_at_epoch"]:
         database.verify_otp_session(session_id, success=False)
         return False, "OTP has expired"
     
@@ -1,30 +1,116 @@
 """
 Payment Service for Payment Gateway
-Handles payment initiation with synchronous OTP generation
+Handles payment initiation with synchronous or queued OTP generation
 """
+import asyncio
+import logging
+import random
+import re
 import time
-from typing import Dict, Any, Optional
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
 
-from config import PAYMENT_RETRY_COUNT, PAYMENT_RETRY_DELAY_MS
-import database
-import otp_service
+from config import (
+    MONGO_MIN_POOL_SIZE,
+    PAYMENT_RETRY_COUNT,
+    PAYMENT_RETRY_DELAY_MS,
+    PAYMENT_MAX_BACKOFF_MS,
+    OTP_MAX_INFLIGHT,
+    OTP_BREAKER_FAILURE_THRESHOLD,
+    OTP_BREAKER_SLEEP_WINDOW_MS,
+    OTP_BREAKER_HALF_OPEN_MAX,
+    OTP_QUEUE_MAXSIZE,
+    OTP_WORKERS,
+    OTP_RESULTS_MAX,
+    OTP_BATCH_MAX_SIZE,
+    OTP_BATCH_WINDOW_MS,
+    MAX_INFLIGHT,
+    SHED_LATENCY_MS,
+    SHED_WINDOW_MS,
+    SHED_MIN_SAMPLES,
+    SHED_REFRESH_MS
+)
+from prometheus_client import Histogram
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from otp_batcher import BatchedOTPCreator
+# Bound once at import, so hot paths skip the module attribute lookup
+from database import create_payment_intent as _create_payment_intent
+from database import release_payment_ready as _release_payment_ready
+from database import warmup as _warmup_database
+from otp_service import RETRYABLE_OTP_ERRORS
+from otp_service import verify_otp as _verify_otp
 
+logger = logging.getLogger(__name__)
+
+# Per-phase latency, so p99 under traffic (and retry amplification) is measurable
+PHASE_LATENCY_MS = Histogram(
+    "payment_phase_duration_ms",
+    "Duration of payment phases in milliseconds",
+    ["phase", "result"],
+    buckets=[1, 5, 10, 25, 50, 100, 250, 1000]
+)
+
+# Shared by all requests: once OTP generation keeps failing, stop retrying
+# into it and fail fast until it has had time to recover
+OTP_BREAKER = CircuitBreaker(
+    failure_threshold=OTP_BREAKER_FAILURE_THRESHOLD,
+    sleep_window_ms=OTP_BREAKER_SLEEP_WINDOW_MS,
+    half_open_max=OTP_BREAKER_HALF_OPEN_MAX
+)
+
+# Bulkhead around OTP generation: under contention requests queue here
+# instead of piling more concurrent work onto the database
+OTP_SEMAPHORE = asyncio.Semaphore(OTP_MAX_INFLIGHT)
+
+# Concurrent OTP creations are coalesced into one multi-document write;
+# each write records its outcome on OTP_BREAKER once, not once per payment
+OTP_BATCHER = BatchedOTPCreator(
+    max_batch=OTP_BATCH_MAX_SIZE,
+    window_ms=OTP_BATCH_WINDOW_MS,
+    breaker=OTP_BREAKER
+)
+
+# Load shedding state: recent (monotonic timestamp, OTP duration ms) samples
+# and the number of initiate_payment calls in flight
+_otp_latencies: deque = deque(maxlen=256)
+_inflight = 0
+# p99 of _otp_latencies, recomputed at most every SHED_REFRESH_MS so the
+# per-request shedding check is a float compare, not a sort
+_shed_p99_ms = 0.0
+_shed_p99_refreshed = 0.0
+
+# Compiled once; malformed card details are rejected before any DB work
+_CARD_RE = re.compile(r"\d{13,19}")
+_EXPIRY_RE = re.compile(r"(0[1-9]|1[0-2])/\d{2}")
+_CVV_RE = re.compile(r"\d{3,4}")
+
+# Payments initiated asynchronously wait here for an OTP worker; a full
+# queue is reported back to the caller (503) instead of buffering forever.
+# Created by start_otp_workers(), in the loop the workers run on
+otp_queue: Optional[asyncio.Queue] = None
+_otp_workers: List[asyncio.Task] = []
+# Queue slots promised to payments still being written, so a slot checked
+# before the write is guaranteed to be there after it
+_otp_queue_reserved = 0
+
+# payment_id -> PaymentResult once its OTP is generated (None while pending)
+_otp_results: Dict[str, Optional["PaymentResult"]] = {}
+
+
+class OTPQueueFullError(Exception):
+    """Raised when the OTP queue has no room for another payment"""
+
+
+@dataclass(slots=True)
 class PaymentResult:
     """Result of a payment operation"""
-    def __init__(
-        self,
-        success: bool,
-        message: str,
-        session_id: Optional[str] = None,
-        otp: Optional[str] = None,
-        payment_id: Optional[str] = None
-    ):
-        self.success = success
-        self.message = message
-        self.session_id = session_id
-        self.otp = otp
-        self.payment_id = payment_id
+    success: bool
+    message: str
+    session_id: Optional[str] = None
+    otp: Optional[str] = None
+    payment_id: Optional[str] = None
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -36,7 +122,7 @@ class PaymentResult:
         }
 
 
-def initiate_payment(
+async def initiate_payment(
     merchant_id: str,
     card_number: str,
     expiry: str,
@@ -62,18 +148,50 @@ def initiate_payment(
     - More load = slower payment creation
     - Slower creation = more timeouts
     - More timeouts = more retries (amplification loop)
+    
+    OTP_BREAKER breaks that loop: after repeated OTP failures it opens and
+    new payments fail fast instead of retrying into a degraded service.
+    OTP_SEMAPHORE bounds how many OTP generations run at once, and
+    OTP_BATCHER folds the ones that do run into shared database writes.
+    
+    Blocking database work runs in worker threads, so waiting here never
+    stalls the event loop.
+    
+    When OTP latency or concurrency says the system is saturated, new
+    payments are shed before they reach the database at all.
     """
-    # Validate card (basic)
+    if _should_shed():
+        return PaymentResult(success=False, message="System busy, please retry")
+    
+    global _inflight
+    _inflight += 1
+    try:
+        return await _initiate_payment(
+            merchant_id, card_number, expiry, cvv, holder_name, amount, currency
+        )
+    finally:
+        _inflight -= 1
+
+
+async def _initiate_payment(
+    merchant_id: str,
+    card_number: str,
+    expiry: str,
+    cvv: str,
+    holder_name: str,
+    amount: float,
+    currency: str
+) -> PaymentResult:
+    """initiate_payment once it has been admitted past load shedding"""
+    # Validate card (basic) - cheap, and keeps junk traffic off the database
+    if not _valid_card(card_number, expiry, cvv):
+        return PaymentResult(success=False, message="Invalid card details")
     card_last_four = card_number[-4:]
     
     # Step 1: Create payment intent
     try:
-        payment = database.create_payment_intent(
-            merchant_id=merchant_id,
-            amount=amount,
-            currency=currency,
-            card_last_four=card_last_four,
-            holder_name=holder_name
+        payment = await _create_payment(
+            merchant_id, card_last_four, holder_name, amount, currency
         )
     except Exception as e:
         return PaymentResult(
@@ -82,51 +200,326 @@ def initiate_payment(
         )
     
     # Step 2: Generate OTP (with retries)
-    # This is where the hidden dependency manifests
-    session_id = None
-    otp_code = None
-    last_error = None
+    return await _generate_otp(payment["_id"])
+
+
+async def _generate_otp(payment_id) -> PaymentResult:
+    """
+    Generate the OTP for a stored payment intent, retrying with backoff.
     
+    Shared by the synchronous flow and the OTP queue workers.
+    """
+    try:
+        return await _attempt_otp(payment_id)
+    finally:
+        # Success, failure, error or cancellation: nothing will wait on this
+        # payment's readiness event any more, so don't let it linger
+        _release_payment_ready(payment_id)
+
+
+async def _attempt_otp(payment_id) -> PaymentResult:
+    """_generate_otp's retry loop"""
+    # The id leaves the service as a string; convert it once, not per exit
+    payment_ref = str(payment_id)
+    
+    # This is where the hidden dependency manifests
     for attempt in range(PAYMENT_RETRY_COUNT):
-        session_id, otp_code, error = otp_service.create_otp_for_payment(
-            payment["_id"]
+        # Fail fast while the circuit is open instead of adding more load
+        try:
+            OTP_BREAKER.before_call()
+        except CircuitOpenError:
+            return PaymentResult(
+                success=False,
+                message="OTP service temporarily unavailable",
+                payment_id=payment_ref
+            )
+        
+        started = time.monotonic()
+        try:
+            async with OTP_SEMAPHORE:
+                session_id, otp_code, error = await OTP_BATCHER.submit(payment_id)
+        except BaseException:
+            # Cancelled, or the batch failed (which OTP_BATCHER already
+            # recorded) - either way don't keep a half-open trial slot
+            OTP_BREAKER.release_call()
+            raise
+        finished = time.monotonic()
+        duration_ms = (finished - started) * 1000
+        _otp_latencies.append((finished, duration_ms))
+        _record_phase(
+            "otp_attempt",
+            duration_ms,
+            "ok" if error is None else error.kind,
+            attempt=attempt
         )
         
-        if session_id and otp_code:
+        # OTP_BATCHER records the batch's outcome on the breaker; this
+        # payment's own error only decides whether it retries
+        if error is None:
             # Success!
-            break
+            return PaymentResult(
+                success=True,
+                message="OTP generated successfully",
+                session_id=session_id,
+                otp=otp_code,  # Returned for demo purposes
+                payment_id=payment_ref
+            )
         
-        if error:
-            last_error = error
+        if error.kind not in RETRYABLE_OTP_ERRORS:
+            # This payment just can't get an OTP, which says nothing about
+            # the OTP service's health - give back the trial slot, if any
+            OTP_BREAKER.release_call()
+            break
         
         # If OTP generation failed (timeout), retry after delay
-        # WARNING: This retry logic amplifies load under contention
+        # WARNING: This retry logic amplifies load under contention, so back
+        # off exponentially with full jitter to avoid synchronized retry waves
         if attempt < PAYMENT_RETRY_COUNT - 1:
-            time.sleep(PAYMENT_RETRY_DELAY_MS / 1000.0)
+            backoff_ms = min(PAYMENT_MAX_BACKOFF_MS, PAYMENT_RETRY_DELAY_MS * (2 ** attempt))
+            await asyncio.sleep(random.uniform(0, backoff_ms) / 1000.0)
+    
+    # OTP generation failed after all retries (or on a terminal error)
+    # This failure is SILENT - no crash, just degraded service
+    return PaymentResult(
+        success=False,
+        message="Unable to generate OTP. Please try again.",
+        payment_id=payment_ref
+    )
+
+
+def _record_phase(phase: str, duration_ms: float, result: str, **fields):
+    """Emit a structured timing event and feed the latency histogram"""
+    PHASE_LATENCY_MS.labels(phase=phase, result=result).observe(duration_ms)
+    logger.info(
+        phase,
+        extra={"phase": phase, "duration_ms": round(duration_ms, 3), "result": result, **fields}
+    )
+
+
+def _should_shed() -> bool:
+    """
+    Decide whether to turn a new payment away.
+    
+    Sheds when too many payments are in flight, or when the p99 of recent
+    OTP generations (within SHED_WINDOW_MS) is close to the OTP timeout.
+    Old samples age out, so once shedding lets the system recover it
+    stops shedding instead of staying stuck on stale latencies.
+    """
+    if _inflight >= MAX_INFLIGHT:
+        return True
+    
+    now = time.monotonic()
+    if (now - _shed_p99_refreshed) * 1000 >= SHED_REFRESH_MS:
+        _refresh_shed_p99(now)
+    return _shed_p99_ms > SHED_LATENCY_MS
+
+
+def _refresh_shed_p99(now: float):
+    """Recompute the cached p99 from samples inside SHED_WINDOW_MS"""
+    global _shed_p99_ms, _shed_p99_refreshed
+    _shed_p99_refreshed = now
+    
+    cutoff = now - SHED_WINDOW_MS / 1000.0
+    recent = sorted(ms for ts, ms in _otp_latencies if ts >= cutoff)
+    if len(recent) < SHED_MIN_SAMPLES:
+        _shed_p99_ms = 0.0
+    else:
+        _shed_p99_ms = recent[int(len(recent) * 0.99)]
+
+
+def _valid_card(card_number: str, expiry: str, cvv: str) -> bool:
+    """Check the card fields are well-formed (card_number already stripped of separators)"""
+    return bool(
+        _CARD_RE.fullmatch(card_number)
+        and _EXPIRY_RE.fullmatch(expiry)
+        and _CVV_RE.fullmatch(cvv)
+    )
+
+
+async def _create_payment(
+    merchant_id: str,
+    card_last_four: str,
+    holder_name: str,
+    amount: float,
+    currency: str
+) -> Dict[str, Any]:
+    """Store the payment intent without blocking the event loop"""
+    started = time.monotonic()
+    result = "error"
+    try:
+        payment = await asyncio.to_thread(
+            _create_payment_intent,
+            merchant_id=merchant_id,
+            amount=amount,
+            currency=currency,
+            card_last_four=card_last_four,
+            holder_name=holder_name
+        )
+        result = "ok"
+        return payment
+    finally:
+        _record_phase("payment_intent", (time.monotonic() - started) * 1000, result)
+
+
+async def enqueue_payment(
+    merchant_id: str,
+    card_number: str,
+    expiry: str,
+    cvv: str,
+    holder_name: str,
+    amount: float,
+    currency: str = "USD"
+) -> PaymentResult:
+    """
+    Initiate a payment and hand OTP generation to the worker pool.
+    
+    Returns as soon as the payment intent is stored, so request latency is
+    just the insert; OTP retries happen off the request path. Poll
+    get_otp_result() with the returned payment_id for the OTP.
+    
+    Raises OTPQueueFullError when the queue is full (explicit backpressure)
+    or the workers aren't running.
+    """
+    if not _valid_card(card_number, expiry, cvv):
+        return PaymentResult(success=False, message="Invalid card details")
+    card_last_four = card_number[-4:]
     
-    if not session_id or not otp_code:
-        # OTP generation failed after all retries
-        # This failure is SILENT - no crash, just degraded service
+    # Reserve a queue slot before writing, so a full queue never leaves an
+    # orphaned payment intent behind
+    global _otp_queue_reserved
+    if otp_queue is None:
+        raise OTPQueueFullError("OTP workers are not running")
+    if otp_queue.qsize() + _otp_queue_reserved >= OTP_QUEUE_MAXSIZE:
+        raise OTPQueueFullError("OTP queue is full")
+    
+    _otp_queue_reserved += 1
+    try:
+        payment = await _create_payment(
+            merchant_id, card_last_four, holder_name, amount, currency
+        )
+    except Exception as e:
         return PaymentResult(
             success=False,
-            message="Unable to generate OTP. Please try again.",
-            payment_id=payment["_id"]
+            message=f"Payment creation failed: {str(e)}"
         )
+    finally:
+        _otp_queue_reserved -= 1
+    
+    pid = payment["_id"]
+    payment_id = str(pid)
+    if otp_queue is None:
+        # Workers stopped while the payment was being written
+        return PaymentResult(
+            success=False,
+            message="OTP workers are not running",
+            payment_id=payment_id
+        )
+    otp_queue.put_nowait(pid)  # Can't be full: the slot was reserved above
+    _store_otp_result(payment_id, None)
     
     return PaymentResult(
         success=True,
-        message="OTP generated successfully",
-        session_id=session_id,
-        otp=otp_code,  # Returned for demo purposes
-        payment_id=payment["_id"]
+        message="Payment accepted, OTP pending",
+        payment_id=payment_id
     )
 
 
+def get_otp_result(payment_id: str) -> Tuple[str, Optional[PaymentResult]]:
+    """
+    Look up the OTP for an asynchronously initiated payment.
+    
+    Returns (status, result) where status is "pending", "ready", "failed"
+    or "unknown" (never queued, or evicted past OTP_RESULTS_MAX).
+    """
+    if payment_id not in _otp_results:
+        return "unknown", None
+    
+    result = _otp_results[payment_id]
+    if result is None:
+        return "pending", None
+    return ("ready" if result.success else "failed"), result
+
+
+def _store_otp_result(payment_id: str, result: Optional[PaymentResult]):
+    """Record a result, evicting the oldest entries past OTP_RESULTS_MAX"""
+    _otp_results[payment_id] = result
+    while len(_otp_results) > OTP_RESULTS_MAX:
+        del _otp_results[next(iter(_otp_results))]
+
+
+async def _otp_worker(queue: asyncio.Queue):
+    """Pull queued payments and generate their OTPs"""
+    while True:
+        try:
+            pid = await queue.get()
+        except Exception:
+            # A dead worker leaves every queued payment pending forever, so
+            # log and keep going (pausing briefly rather than spinning)
+            logger.exception("OTP worker failed to take a payment")
+            await asyncio.sleep(0.1)
+            continue
+        
+        payment_id = str(pid)
+        try:
+            result = await _generate_otp(pid)
+        except Exception as e:
+            result = PaymentResult(
+                success=False,
+                message=f"OTP generation failed: {str(e)}",
+                payment_id=payment_id
+            )
+        finally:
+            queue.task_done()
+        _store_otp_result(payment_id, result)
+
+
+async def warmup(connections: int = MONGO_MIN_POOL_SIZE):
+    """
+    Fill the database connection pool before traffic arrives, so the first
+    burst of payments doesn't queue behind connection handshakes.
+    """
+    await asyncio.to_thread(_warmup_database, connections)
+
+
+def start_otp_workers(count: int = OTP_WORKERS):
+    """Start the OTP worker pool (call from the running event loop)"""
+    global otp_queue
+    if otp_queue is None:
+        otp_queue = asyncio.Queue(maxsize=OTP_QUEUE_MAXSIZE)
+    for _ in range(count - len(_otp_workers)):
+        _otp_workers.append(asyncio.create_task(_otp_worker(otp_queue)))
+
+
+async def stop_otp_workers():
+    """Cancel the OTP worker pool and drain the OTP batcher"""
+    global otp_queue
+    for task in _otp_workers:
+        task.cancel()
+    await asyncio.gather(*_otp_workers, return_exceptions=True)
+    _otp_workers.clear()
+    
+    # The queue belongs to this loop; fail what's left instead of leaving
+    # those payments pending forever
+    if otp_queue is not None:
+        while not otp_queue.empty():
+            pid = otp_queue.get_nowait()
+            _release_payment_ready(pid)
+            payment_id = str(pid)
+            _store_otp_result(payment_id, PaymentResult(
+                success=False,
+                message="OTP workers stopped",
+                payment_id=payment_id
+            ))
+        otp_queue = None
+    
+    await OTP_BATCHER.close()
+
+
 def verify_payment(session_id: str, otp_code: str) -> PaymentResult:
     """
     Verify payment with OTP.
     """
-    success, message = otp_service.verify_otp(session_id, otp_code)
+    success, message = _verify_otp(session_id, otp_code)
     
     return PaymentResult(
         success=success,
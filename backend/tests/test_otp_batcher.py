@@ -0,0 +1,83 @@
+"""
+Tests for OTP batching and its circuit breaker bookkeeping
+
+Run from backend/: python -m unittest discover -s tests
+No MongoDB needed - the database calls are patched out.
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+import circuit_breaker
+import database
+import payment_service
+
+
+def _found(payment_ids, timeout_ms=400, projection=None):
+    return [{"_id": payment_id} for payment_id in payment_ids]
+
+
+def _sessions(entries):
+    return [{"_id": ObjectId()} for _ in entries]
+
+
+class BatchedOTPBreakerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        breaker = payment_service.OTP_BREAKER
+        breaker.state = circuit_breaker.CLOSED
+        breaker._failures = 0
+        breaker._half_open_calls = 0
+
+        for target, kwargs in [
+            ("get_payment_intents", {"side_effect": _found}),
+            ("is_payment_tracked", {"return_value": True}),
+        ]:
+            patcher = mock.patch.object(database, target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await payment_service.OTP_BATCHER.close()
+
+    async def test_failed_batch_counts_as_one_breaker_failure(self):
+        # One network blip on the first batched write, then the database is fine
+        blips = [AutoReconnect("blip")]
+
+        def create_otp_sessions(entries):
+            if blips:
+                raise blips.pop()
+            return _sessions(entries)
+
+        breaker = payment_service.OTP_BREAKER
+        with mock.patch.object(database, "create_otp_sessions", side_effect=create_otp_sessions), \
+                mock.patch.object(breaker, "record_failure", wraps=breaker.record_failure) as record_failure:
+            results = await asyncio.gather(*[
+                payment_service._generate_otp(ObjectId()) for _ in range(10)
+            ])
+
+        self.assertEqual(record_failure.call_count, 1)
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        # The blip was retried, not turned into "OTP service temporarily unavailable"
+        self.assertTrue(all(result.success for result in results))
+
+    async def test_batch_of_terminal_errors_leaves_breaker_alone(self):
+        breaker = payment_service.OTP_BREAKER
+        with mock.patch.object(database, "is_payment_tracked", return_value=False), \
+                mock.patch.object(database, "get_payment_intents", side_effect=lambda ids, **_: [None] * len(ids)), \
+                mock.patch.object(breaker, "record_failure", wraps=breaker.record_failure) as record_failure, \
+                mock.patch.object(breaker, "record_success", wraps=breaker.record_success) as record_success:
+            results = await asyncio.gather(*[
+                payment_service._generate_otp(ObjectId()) for _ in range(5)
+            ])
+
+        self.assertFalse(any(result.success for result in results))
+        self.assertEqual(record_failure.call_count, 0)
+        self.assertEqual(record_success.call_count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,43 +8,71 @@ import asyncio
 import aiohttp
 import random
 import sys
-from datetime import datetime
+import time
 
 
-async def make_payment(session: aiohttp.ClientSession, base_url: str):
+# Static request fields, built once; only holder_name and amount vary
+_BASE_PAYLOAD = {
+    "card_number": "4111111111111111",
+    "expiry": "12/25",
+    "cvv": "123",
+}
+_HOLDER_NAMES = [f"Bot User {i}" for i in range(1, 1001)]
+
+# Shared stats are a plain [total, success, failed] list
+_TOTAL, _SUCCESS, _FAILED = range(3)
+_STATS_FLUSH_EVERY = 10  # Requests a worker tallies locally before publishing
+
+
+async def make_payment(session: aiohttp.ClientSession, base_url: str, rng: random.Random):
     """Make a single payment request"""
     payload = {
-        "card_number": "4111111111111111",
-        "expiry": "12/25",
-        "cvv": "123",
-        "holder_name": f"Bot User {random.randint(1, 1000)}",
-        "amount": random.uniform(10.0, 500.0),
+        **_BASE_PAYLOAD,
+        "holder_name": _HOLDER_NAMES[rng.randrange(len(_HOLDER_NAMES))],
+        "amount": rng.uniform(10.0, 500.0),
     }
     
     try:
-        async with session.post(
-            f"{base_url}/payment/initiate",
-            json=payload,
-            timeout=aiohttp.ClientTimeout(total=30)
-        ) as response:
+        async with session.post(f"{base_url}/payment/initiate", json=payload) as response:
             result = await response.json()
             return result.get("success", False)
     except:
         return False
 
 
-async def continuous_traffic(session: aiohttp.ClientSession, base_url: str, stats: dict):
-    """Generate continuous traffic"""
-    while True:
-        success = await make_payment(session, base_url)
-        stats["total"] += 1
-        if success:
-            stats["success"] += 1
-        else:
-            stats["failed"] += 1
-        
-        # Very short delay to maintain high concurrency
-        await asyncio.sleep(random.uniform(0.05, 0.2))
+async def continuous_traffic(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    stats: list,
+    stop: asyncio.Event
+):
+    """Generate continuous traffic until stop is set"""
+    # Per-worker RNG, so workers don't share the module-level generator
+    rng = random.Random()
+    # Tallied locally and folded into the shared counters every few requests
+    local_success = local_failed = 0
+    try:
+        while not stop.is_set():
+            if await make_payment(session, base_url, rng):
+                local_success += 1
+            else:
+                local_failed += 1
+            
+            if local_success + local_failed >= _STATS_FLUSH_EVERY:
+                _flush_stats(stats, local_success, local_failed)
+                local_success = local_failed = 0
+            
+            # Very short delay to maintain high concurrency
+            await asyncio.sleep(rng.uniform(0.05, 0.2))
+    finally:
+        _flush_stats(stats, local_success, local_failed)
+
+
+def _flush_stats(stats: list, success: int, failed: int):
+    """Add a worker's local tallies to the shared [total, success, failed] counters"""
+    stats[_TOTAL] += success + failed
+    stats[_SUCCESS] += success
+    stats[_FAILED] += failed
 
 
 async def run_simulator(base_url: str = "http://54.236.22.165:8000", workers: int = 30):
@@ -65,29 +93,52 @@ async def run_simulator(base_url: str = "http://54.236.22.165:8000", workers: in
     print("=" * 60)
     print()
     
-    stats = {"total": 0, "success": 0, "failed": 0}
+    stats = [0, 0, 0]
+    
+    # One bounded keep-alive pool shared by every worker: no per-request
+    # connect churn, and offered load is capped at exactly `workers` sockets
+    connector = aiohttp.TCPConnector(
+        limit=workers,
+        limit_per_host=workers,
+        keepalive_timeout=30,
+        enable_cleanup_closed=True
+    )
+    timeout = aiohttp.ClientTimeout(total=30)
+    
+    stop = asyncio.Event()
     
-    async with aiohttp.ClientSession() as session:
-        # Start worker tasks
-        tasks = [
-            asyncio.create_task(continuous_traffic(session, base_url, stats))
-            for _ in range(workers)
-        ]
-        
-        # Print stats every 2 seconds
-        try:
-            while True:
-                await asyncio.sleep(2)
-                rate = (stats["success"] / stats["total"] * 100) if stats["total"] > 0 else 0
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                
-                status = "✅" if rate >= 95 else "⚠️" if rate >= 80 else "❌"
-                print(f"[{timestamp}] {status} Total: {stats['total']:>5} | Success: {stats['success']:>5} | Failed: {stats['failed']:>4} | Rate: {rate:.1f}%")
-        except asyncio.CancelledError:
-            pass
-        finally:
-            for task in tasks:
-                task.cancel()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # The task group only exits once every worker has, so no request or
+        # socket outlives the run
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(workers):
+                tg.create_task(continuous_traffic(session, base_url, stats, stop))
+            
+            # Print stats every 2 seconds, stamped with the start time plus
+            # elapsed seconds so ticks don't each format a fresh wall clock
+            start_wall = time.strftime("%H:%M:%S")
+            started = time.monotonic()
+            
+            # Stats lines go straight to the byte stream, one write + flush
+            # each, so a slow terminal holds the loop for a single syscall
+            sys.stdout.flush()  # Keep the banner ahead of the byte writes
+            out = sys.stdout.buffer
+            try:
+                while True:
+                    await asyncio.sleep(2)
+                    total, success, failed = stats
+                    rate = (success / total * 100) if total > 0 else 0
+                    elapsed = int(time.monotonic() - started)
+                    
+                    status = "✅" if rate >= 95 else "⚠️" if rate >= 80 else "❌"
+                    line = f"[{start_wall}+{elapsed}s] {status} Total: {total:>5} | Success: {success:>5} | Failed: {failed:>4} | Rate: {rate:.1f}%\n"
+                    out.write(line.encode())
+                    out.flush()
+            except asyncio.CancelledError:
+                # Ctrl+C: workers finish their current request, then drain
+                pass
+            finally:
+                stop.set()
 
 
 def main():
@@ -97,10 +148,13 @@ def main():
     if len(sys.argv) > 1:
         workers = int(sys.argv[1])
     
+    # The first Ctrl+C drains the workers and run_simulator returns normally;
+    # a second one while draining interrupts outright
     try:
         asyncio.run(run_simulator(base_url, workers))
     except KeyboardInterrupt:
-        print("\n\nTraffic stopped.")
+        pass
+    print("\n\nTraffic stopped.")
 
 
 if __name__ == "__main__":